@@ -1,30 +1,451 @@
 import streamlit as st
 from google.cloud import speech
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.oauth2 import service_account
 import google.generativeai as genai
 from pydub import AudioSegment # pydub をインポート
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
+from operator import attrgetter
+import hashlib # 同じ音声ファイルを判別するためにインポート
 import json
+import logging
 import io # メモリ上でファイルを扱うためにインポート
 import os # ファイル名を扱うためにインポート
+import re
+import shutil
+import subprocess # ffmpeg を直接呼び出すためにインポート
+import tempfile
+import threading
 import time
+import uuid
 
 # ----- GCS バケット名を設定 -----
 # 重要: このバケット名は、あなたの GCP プロジェクト内に実際に存在する GCS バケットの名前に置き換えてください！
 GCS_BUCKET_NAME = "transcriptionsummarizationapp" # ← ★★★★★ 必ず書き換えてください ★★★★★
 
+logger = logging.getLogger(__name__)
+
+# ----- 変換せずにそのまま STT に渡せる形式 -----
+# FLAC / WAV はヘッダからエンコーディングを判別できるため、再エンコードせずにアップロードする
+# ただし STT が受け付けるのは 16 bit PCM / μ-law の WAV と FLAC のみ。ffprobe でコーデックを確認する
+SUPPORTED_NATIVE_FORMATS = {"flac", "wav"}
+SUPPORTED_NATIVE_CODECS = {"pcm_s16le", "pcm_mulaw", "flac"}
+# Ogg Opus / AMR はエンコーディングとサンプルレートを指定すればそのまま渡せる (ffprobe でコーデックを確認する)
+NATIVE_CODEC_FORMATS = {"ogg", "opus", "amr"}
+NATIVE_CODEC_ENCODINGS = {
+    "opus": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
+    "amr_nb": speech.RecognitionConfig.AudioEncoding.AMR,
+    "amr_wb": speech.RecognitionConfig.AudioEncoding.AMR_WB,
+}
+
+# ----- GCS へのアップロード設定 -----
+# Blob に chunk_size を指定すると resumable upload になり、8 MiB ずつ分割して送信される
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# ----- FLAC 変換の設定 -----
+# 会議音声の文字起こしには 16 kHz モノラルで十分 (アップロード量と時間を削減できる)
+FLAC_SAMPLE_RATE_HERTZ = 16000
+FLAC_CHANNELS = 1
+# ffmpeg が見つからない場合は pydub での変換にフォールバックする
+FFMPEG_PATH = shutil.which("ffmpeg")
+FFPROBE_PATH = shutil.which("ffprobe")
+# 標準入力を cache プロトコル経由で読ませ、シークできるようにする (pydub の from_file と同じ方法)
+# M4A などは moov atom がファイル末尾にあることが多く、そのままのパイプでは読み込めない
+FFMPEG_STDIN_INPUT = ["-read_ahead_limit", "-1", "-i", "cache:pipe:0"]
+
+# ----- 短い音声は GCS を経由せず recognize で直接文字起こしする -----
+INLINE_MAX_SECONDS = 55 # recognize は 1 分以内の音声にしか使えないので余裕をもたせる
+INLINE_MAX_BYTES = 10 * 1024 * 1024 # リクエストに直接載せられる音声データの上限
+
+# ----- 話者分離を行わない場合は streaming_recognize で逐次表示する -----
+STREAMING_CHUNK_SECONDS = 0.1
+STREAMING_CHUNK_BYTES = int(FLAC_SAMPLE_RATE_HERTZ * 2 * FLAC_CHANNELS * STREAMING_CHUNK_SECONDS) # 16 bit PCM の 100 ms 分
+STREAMING_MAX_SECONDS = 290 # 1 回のストリームで送れる音声は約 5 分までなので、それを超える前に張り直す
+
+# ----- 文字起こしの設定 -----
+# 会議のような 1 分を超える長い音声向けのモデルを使う
+STT_MODEL = "latest_long"
+
+
+@st.cache_resource
+def get_recognition_configs():
+    """文字起こしの設定を生成する。
+
+    Streamlit は操作のたびにスクリプト全体を再実行するため、結果をキャッシュしてプロセスごとに 1 回だけ生成する。
+    (共通の RecognitionConfig, FLAC 変換後の音声用の RecognitionConfig, StreamingRecognitionConfig) を返す。
+    """
+    # 話者分離を有効にした RecognitionConfig (FLAC / WAV の場合はエンコ―ディング指定不要)
+    diarization_config = speech.SpeakerDiarizationConfig(
+        enable_speaker_diarization=True,
+        min_speaker_count=2,
+        max_speaker_count=6,
+    )
+    recognition_config = speech.RecognitionConfig(
+        language_code="ja-JP",
+        model=STT_MODEL,
+        enable_automatic_punctuation=True,
+        diarization_config=diarization_config, # 話者分離を再度有効化
+    )
+    # FLAC に変換した音声用 (16 kHz なので STT 側での再サンプリングを省ける)
+    transcoded_recognition_config = speech.RecognitionConfig(
+        recognition_config,
+        sample_rate_hertz=FLAC_SAMPLE_RATE_HERTZ,
+    )
+    # ストリーミング認識用 (ffmpeg でデコードした 16 kHz モノラルの PCM を送る。話者分離なし)
+    streaming_recognition_config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=FLAC_SAMPLE_RATE_HERTZ,
+            language_code="ja-JP",
+            model=STT_MODEL,
+            enable_automatic_punctuation=True,
+        ),
+        interim_results=True,
+    )
+    return recognition_config, transcoded_recognition_config, streaming_recognition_config
+
+
+# ----- 非同期認識 (long_running_recognize) の完了待ち -----
+STT_TIMEOUT_SECONDS = 1800 # 30分程度の音声なら1800秒(30分)くらい見ておく
+STT_POLL_INITIAL_SECONDS = 1.0 # 最初の確認間隔。以降 1.5 倍ずつ延ばす
+STT_POLL_MAX_SECONDS = 10.0 # 完了に気付くのが遅れすぎないよう、間隔の上限を抑える
+
+# ----- Gemini に渡す書き起こしテキストの圧縮 (入力トークンを減らす) -----
+# (Streamlit の再実行のたびにこの部分も評価し直されるが、re.compile の結果は re モジュール内でキャッシュされるので
+#  実際のコンパイルはプロセスごとに 1 回だけになる)
+# STT は日本語でも単語ごとに空白で区切るため、日本語の文字に挟まれた空白を取り除く
+JAPANESE_CHARS = "\u3000-\u303f\u3040-\u30ff\u4e00-\u9fff\uff00-\uffef"
+JAPANESE_SPACE_PATTERN = re.compile(f"(?<=[{JAPANESE_CHARS}])[ \t\u3000]+(?=[{JAPANESE_CHARS}])")
+# 連続する句読点は日本語のものだけを詰める (英数字の "..." や "1..2" は意味が変わるので残す)
+REPEATED_PUNCTUATION_PATTERN = re.compile(r"([。、！？])\1+")
+MULTIPLE_SPACES_PATTERN = re.compile(r"[ \t\u3000]{2,}")
+# STT の言いよどみ: 単独の語として認識されたフィラーと、直後に同じ語が繰り返されたもの (「その その」など)
+FILLER_PATTERN = re.compile(r"(?<!\S)(?:えー+と?|えっと|あのー+|うーん|んー+)(?!\S)")
+REPEATED_WORD_PATTERN = re.compile(r"(?<!\S)([\u3040-\u30ff\u4e00-\u9fff]+)(?:[ \t\u3000]+\1)+(?!\S)")
+
+# ----- 同じ音声の処理結果を再利用する -----
+RESULT_CACHE_MAX_ENTRIES = 32 # 保持する処理結果の数 (古いものから捨てる)
+
+
+# ----- ffmpeg による変換をアップロード・認識と並行して行うためのヘルパー -----
+class PipeReader:
+    """シークできないパイプを upload_from_file に渡すためのラッパー。
+
+    resumable upload は tell() で送信位置を確認するため、読み込んだバイト数を自前で数える。
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._position = 0
+
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # 現在位置へのシーク (実質何もしない) だけを許可する
+        if whence == io.SEEK_SET and offset == self._position:
+            return self._position
+        raise io.UnsupportedOperation("パイプはシークできません。")
+
+    def close(self):
+        self._raw.close()
+
+
+def ffmpeg_command(output_format="flac"):
+    """標準入力の音声を 16 kHz モノラルに変換して標準出力に書き出す ffmpeg コマンド。"""
+    return [
+        FFMPEG_PATH, "-loglevel", "error",
+        *FFMPEG_STDIN_INPUT,
+        "-vn", "-ac", str(FLAC_CHANNELS), "-ar", str(FLAC_SAMPLE_RATE_HERTZ),
+        "-f", output_format, "pipe:1",
+    ]
+
+
+def start_ffmpeg(source, output_format="flac"):
+    """アップロードされた音声を ffmpeg に直接流し込み、変換結果を標準出力からストリームで取り出す。
+
+    入力の書き込みは別スレッドで行うので、呼び出し側は proc.stdout を読みながらアップロードや認識を進められる。
+    """
+    # エラー出力はパイプにせず一時ファイルに書かせる (stdout を読み終えるまで stderr を読まないため、
+    # パイプだとバッファが一杯になった時点で ffmpeg が止まり、デッドロックする)
+    error_log = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        ffmpeg_command(output_format),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=error_log,
+    )
+
+    def feed():
+        try:
+            shutil.copyfileobj(source, proc.stdin)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass # ffmpeg が先に終了した場合 (エラー内容は error_log から取得する)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    return proc, feeder, error_log
+
+
+def wait_ffmpeg(proc, feeder, error_log):
+    """ffmpeg の終了を待ち、失敗していれば例外を送出する。"""
+    feeder.join()
+    with error_log:
+        returncode = proc.wait()
+        error_log.seek(0)
+        error_output = error_log.read().decode(errors="replace").strip()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg による音声変換に失敗しました: {error_output}")
+
+
+def encode_flac(data):
+    """短い音声をまとめて FLAC に変換し、バイト列で返す。"""
+    result = subprocess.run(ffmpeg_command(), input=data, capture_output=True)
+    if result.returncode != 0:
+        error_output = result.stderr.decode(errors="replace").strip()
+        raise RuntimeError(f"ffmpeg による FLAC 変換に失敗しました: {error_output}")
+    return result.stdout
+
+
+def probe_audio(data):
+    """ffprobe で音声の長さ (秒)・コーデック・サンプルレート・チャンネル数を調べる。
+
+    判定できなかった項目は None になる。ffprobe が使えない場合はすべて None。
+    """
+    info = {"duration": None, "codec_name": None, "sample_rate": None, "channels": None}
+    if not FFPROBE_PATH:
+        return info
+    try:
+        result = subprocess.run(
+            [
+                FFPROBE_PATH, "-v", "error",
+                "-select_streams", "a:0",
+                "-show_entries", "format=duration:stream=codec_name,sample_rate,channels",
+                "-of", "json",
+                *FFMPEG_STDIN_INPUT,
+            ],
+            input=data,
+            capture_output=True,
+            timeout=60,
+            check=True,
+        )
+        probed = json.loads(result.stdout)
+    except (subprocess.SubprocessError, ValueError):
+        return info
+
+    streams = probed.get("streams") or [{}]
+    info["codec_name"] = streams[0].get("codec_name")
+    try:
+        info["duration"] = float(probed.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        pass
+    try:
+        info["sample_rate"] = int(streams[0].get("sample_rate"))
+    except (TypeError, ValueError):
+        pass
+    info["channels"] = streams[0].get("channels")
+    return info
+
+
+def is_short_audio(duration_seconds):
+    """GCS を経由せず recognize で処理できる長さかどうか。"""
+    return duration_seconds is not None and duration_seconds < INLINE_MAX_SECONDS
+
+
+def transcribe_streaming(speech_client, pcm_stream, container, on_segment=None, on_response=None):
+    """16 kHz モノラルの PCM を 100 ms ずつ streaming_recognize に送り、認識結果を container に順次表示する。
+
+    ストリーミング認識は実時間程度の速さで音声が届くことを前提としているため、再生速度に合わせて送る
+    (音声の長さと同程度の時間がかかる)。確定した結果は 1 回だけ追記し、未確定の結果は末尾に仮表示する。
+    on_segment を指定すると、ストリームを張り直すたびに直前の区間の確定テキストを渡して呼び出す。
+    on_response を指定すると、認識結果を受け取るたびに (表示の更新後に) 呼び出す。
+    (確定した全文, 最後の区間の確定テキスト) を返す。
+    """
+    _, _, streaming_recognition_config = get_recognition_configs()
+    chunks_per_stream = STREAMING_MAX_SECONDS * 10
+    # 確定した結果は final_area に追記していき、書き換えるのは末尾の仮表示だけにする
+    # (毎回全文を送り直すと、長い音声では送信量が文字数の 2 乗で増える)
+    final_area = container.container()
+    interim_placeholder = container.empty()
+    final_texts = []
+    segment_start = 0
+
+    while True:
+        first_chunk = pcm_stream.read(STREAMING_CHUNK_BYTES)
+        if not first_chunk:
+            break
+        if on_segment and len(final_texts) > segment_start:
+            # 次の区間に進む時点で、直前の区間の文字起こしは確定している
+            on_segment("\n".join(final_texts[segment_start:]))
+        segment_start = len(final_texts)
+
+        def requests(first_chunk=first_chunk):
+            stream_started = time.monotonic()
+            yield speech.StreamingRecognizeRequest(audio_content=first_chunk)
+            for index in range(1, chunks_per_stream):
+                chunk = pcm_stream.read(STREAMING_CHUNK_BYTES)
+                if not chunk:
+                    return
+                # 速く送りすぎると "Audio data is being streamed too fast" で拒否されるので、再生位置に合わせて待つ
+                delay = stream_started + index * STREAMING_CHUNK_SECONDS - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+        for response in speech_client.streaming_recognize(streaming_recognition_config, requests()):
+            interim_texts = []
+            for result in response.results:
+                if not result.alternatives:
+                    continue
+                if result.is_final:
+                    final_texts.append(result.alternatives[0].transcript)
+                    final_area.markdown(result.alternatives[0].transcript.strip())
+                else:
+                    interim_texts.append(result.alternatives[0].transcript)
+            interim_placeholder.markdown("".join(interim_texts).strip())
+            if on_response:
+                on_response()
+
+    return "\n".join(final_texts), "\n".join(final_texts[segment_start:])
+
+
+def wait_for_operation(operation, progress_bar):
+    """long_running_recognize の完了を間隔を延ばしながら確認し、進捗をプログレスバーに表示する。"""
+    deadline = time.monotonic() + STT_TIMEOUT_SECONDS
+    interval = STT_POLL_INITIAL_SECONDS
+    while not operation.done():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"文字起こしが {STT_TIMEOUT_SECONDS} 秒以内に完了しませんでした。")
+        time.sleep(interval)
+        interval = min(interval * 1.5, STT_POLL_MAX_SECONDS)
+        progress_percent = operation.metadata.progress_percent if operation.metadata else 0
+        progress_bar.progress(progress_percent, text=f"文字起こしの進捗: {progress_percent}%")
+    progress_bar.progress(100, text="文字起こしの進捗: 100%")
+    return operation.result()
+
+
+def compact_transcript(text):
+    """フィラーや言いよどみを除き、日本語の間の空白や連続する句読点を詰めて、Gemini に渡す書き起こしテキストを短くする。"""
+    # 語の区切りを手がかりにするため、空白を詰める前に処理する
+    text = FILLER_PATTERN.sub("", text)
+    text = REPEATED_WORD_PATTERN.sub(r"\1", text)
+    text = JAPANESE_SPACE_PATTERN.sub("", text)
+    text = REPEATED_PUNCTUATION_PATTERN.sub(r"\1", text)
+    text = MULTIPLE_SPACES_PATTERN.sub(" ", text)
+    return text.strip()
+
+
+def summarize_segment(gemini_model, segment_text):
+    """会議の一区間分の書き起こしをログ形式に編集し、要点をまとめる。文字起こしと並行してバックグラウンドで実行される。
+
+    {"log": 編集したログ, "points": 区間の要点} を返す。
+    """
+    prompt = f"""
+    以下は会議書き起こしテキストの一部です。
+    Google StTによる書き起こしテキストを日本語に編集しログ形式にしたものを "log" に、
+    この区間の要点を箇条書きで簡潔にまとめたものを "points" に入れた JSON を出力してください。
+    --- 書き起こしテキスト ---
+    {compact_transcript(segment_text)}
+    """
+    response = gemini_model.generate_content(
+        prompt,
+        generation_config={"response_mime_type": "application/json"}, # ログと要点を分けて受け取る
+    )
+    result = json.loads(response.text)
+    return {"log": str(result["log"]).strip(), "points": str(result["points"]).strip()}
+
+
+def render_segment_summaries(placeholder, futures):
+    """区間ごとの暫定要約を表示する。まだ生成中の区間はその旨を表示する。"""
+    sections = []
+    for index, future in enumerate(futures, start=1):
+        if not future.done():
+            body = "_要約を生成中..._"
+        elif future.exception():
+            body = f"要約の生成中にエラーが発生しました: {future.exception()}"
+        else:
+            body = future.result()["points"]
+        sections.append(f"**区間 {index}**\n\n{body}")
+    placeholder.markdown("#### 📝 暫定要約 (区間ごと)\n\n" + "\n\n".join(sections))
+
+
+def render_summary(gemini_model, full_raw_text, segment_results=None, last_segment_text=""):
+    """Gemini API で書き起こしテキストを要約して表示する。生成した要約を返す (失敗した場合は None)。
+
+    segment_results (summarize_segment の結果のリスト) を指定すると、全文ではなく区間ごとの要点と
+    最後の区間の書き起こしを統合して要約する。区間ごとに編集したログはそのまま先頭に表示する。
+    """
+    st.subheader("📝 AIによる要約 (Gemini)")
+    with st.spinner("Gemini API で要約を生成中..."):
+        segment_logs = ""
+        if segment_results:
+            segment_logs = "\n\n".join(result["log"] for result in segment_results) + "\n\n"
+            segment_sections = "\n\n".join(
+                f"[区間 {index}]\n{result['points']}" for index, result in enumerate(segment_results, start=1)
+            )
+            prompt = f"""
+            以下は長い会議の書き起こしについて、前半の区間ごとにまとめた要点と、最後の区間の書き起こしテキストです。
+            まずは最後の区間のGoogle StTによる書き起こしテキストを日本語に編集しログ形式で出力した後、
+            区間ごとの要点と合わせて、会議全体の主要な議題とそれぞれの内容の要点を箇条書きで簡潔にまとめてください。
+            --- 区間ごとの要点 ---
+            {segment_sections}
+            --- 最後の区間の書き起こしテキスト ---
+            {compact_transcript(last_segment_text)}
+            --- 要約 ---
+            """
+        else:
+            prompt = f"""
+            以下の会議書き起こしテキストを分析し、主要な議題とそれぞれの内容の要点を箇条書きで簡潔にまとめてください。
+            まずはGoogle StTによる書き起こしテキストを日本語に編集しログ形式で出力した後、その内容の要点をまとめてください。
+            --- 書き起こしテキスト ---
+            {compact_transcript(full_raw_text)}
+            --- 要約 ---
+            """
+        # 生成された部分から順に表示する (全文の生成完了を待たない)
+        summary_placeholder = st.empty()
+        summary_chunks = [segment_logs] # 前半の区間のログは生成済みなので、続けて表示する
+        if segment_logs:
+            summary_placeholder.markdown(segment_logs)
+        try:
+            for chunk in gemini_model.generate_content(prompt, stream=True):
+                if chunk.parts: # 本文を含まないチャンク (終了通知など) は読み飛ばす
+                    summary_chunks.append(chunk.text)
+                    summary_placeholder.markdown("".join(summary_chunks))
+            st.success("要約が完了しました。")
+            return "".join(summary_chunks)
+        except Exception as e:
+            st.error(f"Gemini API での要約生成中にエラーが発生しました: {e}")
+            return None
+
+
 # ----- アプリのタイトル -----
 st.title("🚀 会議文字起こし＆要約アプリ (Google Cloud STT + Gemini)")
-st.write("音声ファイル (M4Aなども可) をアップロードし、FLACに変換後、文字起こし、話者分離整形、AIによる要約を行います。")
-st.caption(f"一時ファイルは Google Cloud Storage バケット '{GCS_BUCKET_NAME}' に FLAC 形式でアップロードされます。")
+st.write("音声ファイル (M4Aなども可) をアップロードし、必要に応じてFLACに変換後、文字起こし、話者分離整形、AIによる要約を行います。")
+st.caption(f"一時ファイルは Google Cloud Storage バケット '{GCS_BUCKET_NAME}' にアップロードされます (FLAC / WAV / Ogg Opus / AMR はそのまま、その他は FLAC に変換)。")
 
 # ----- APIキーと認証情報の設定 (Streamlit Secrets から読み込み) -----
 speech_client = None
 storage_client = None
+gcs_bucket = None
 gemini_model = None
 can_summarize = False
 
-try:
+
+@st.cache_resource
+def get_clients():
+    """認証情報を読み込み、各 API クライアントを生成する。
+
+    Streamlit は操作のたびにスクリプト全体を再実行するため、結果をキャッシュしてプロセスごとに 1 回だけ生成する。
+    """
     # Google Cloud 用の認証情報 (バックスラッシュをエスケープした形式を想定)
     google_credentials_json_str = st.secrets["google_credentials_json"]
     # ここでバックスラッシュのエスケープを元に戻す必要があるかもしれないので注意
@@ -34,16 +455,71 @@ try:
 
     # Speech-to-Text クライアント
     speech_client = speech.SpeechClient(credentials=credentials)
-    st.sidebar.success("Google Cloud STT 認証 OK")
 
     # Google Cloud Storage クライアント
     storage_client = storage.Client(credentials=credentials)
-    st.sidebar.success("Google Cloud Storage 認証 OK")
+    # 一時ファイル用のバケット (リクエストごとに作り直さない)
+    gcs_bucket = storage_client.bucket(GCS_BUCKET_NAME)
 
     # Gemini API キー
     gemini_api_key = st.secrets["gemini_api_key"]
     genai.configure(api_key=gemini_api_key)
     gemini_model = genai.GenerativeModel('gemini-1.5-pro-latest')
+
+    return speech_client, storage_client, gcs_bucket, gemini_model
+
+
+@st.cache_resource
+def get_background_executor():
+    """GCS の一時ファイル削除や暫定要約をバックグラウンドで行うためのスレッドプール (プロセスで共有)。"""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def get_result_cache():
+    """同じ音声の文字起こし・要約結果を再利用するためのキャッシュ (音声のハッシュをキーにプロセスで共有)。
+
+    複数のセッションが別スレッドから同時に読み書きするため、ロックと組にして返す。
+    """
+    return OrderedDict(), threading.Lock()
+
+
+def load_result(key):
+    """キャッシュから処理結果を取り出す。見つからなければ None を返す。"""
+    result_cache, lock = get_result_cache()
+    with lock:
+        result = result_cache.get(key)
+        if result is not None:
+            result_cache.move_to_end(key) # 最近使ったものほど残りやすくする
+        return result
+
+
+def store_result(key, transcript_text, full_raw_text, summary_text):
+    """処理結果をキャッシュに保存する。上限を超えたら古いものから捨てる。"""
+    result_cache, lock = get_result_cache()
+    with lock:
+        result_cache[key] = {
+            "transcript_text": transcript_text,
+            "full_raw_text": full_raw_text,
+            "summary_text": summary_text,
+        }
+        result_cache.move_to_end(key)
+        while len(result_cache) > RESULT_CACHE_MAX_ENTRIES:
+            result_cache.popitem(last=False)
+
+
+def delete_gcs_blob(blob):
+    """GCS の一時ファイルを削除する。バックグラウンドで実行されるため、失敗はログに残すだけにする。"""
+    try:
+        blob.delete()
+    except Exception as e:
+        logger.warning("GCS からの一時ファイル %s の削除中にエラー: %s", blob.name, e)
+
+
+try:
+    speech_client, storage_client, gcs_bucket, gemini_model = get_clients()
+    st.sidebar.success("Google Cloud STT 認証 OK")
+    st.sidebar.success("Google Cloud Storage 認証 OK")
     st.sidebar.success("Gemini API 認証 OK")
     can_summarize = True
 
@@ -69,21 +545,129 @@ uploaded_file = st.file_uploader(
 )
 
 if uploaded_file is not None and speech_client and storage_client:
-    st.audio(uploaded_file, format=uploaded_file.type)
+    # アップロードされたデータは一度だけ取り出し、プレーヤー・変換・アップロードで共有する
+    audio_data = uploaded_file.getvalue()
+    st.audio(audio_data, format=uploaded_file.type)
 
-    if st.button("文字起こしと要約を実行"):
+    # 話者分離は非同期処理でのみ行う。オフにすると streaming_recognize で結果を逐次表示する (ffmpeg が必要)
+    use_diarization = st.checkbox(
+        "話者分離を行う (オフにすると話者分離なしで文字起こし結果を逐次表示します。音声の長さと同程度の時間がかかります)",
+        value=True,
+        disabled=not FFMPEG_PATH,
+    )
+    run_clicked = st.button("文字起こしと要約を実行")
+    cached_result = None
+    if run_clicked:
+        # 内容のハッシュで同じ音声かどうかを判別する (処理結果のキャッシュに使う)
+        # 操作のたびにファイル全体をハッシュしないよう、実行ボタンが押されたときだけ計算する
+        audio_digest = hashlib.blake2b(audio_data, digest_size=16).hexdigest()
+        result_key = (audio_digest, use_diarization)
+        cached_result = load_result(result_key)
+
+    if run_clicked and cached_result is not None:
+        # --- 同じ音声を処理済みの場合は、文字起こし・要約をやり直さず結果を再利用する ---
+        st.info("同じ音声ファイルの処理結果があるため、文字起こしを省略して再利用します。")
+        st.subheader("🗣️ 話者分離 整形済みスクリプト" if use_diarization else "🗣️ 文字起こし")
+        st.markdown(cached_result["transcript_text"])
+        if cached_result["summary_text"]:
+            st.subheader("📝 AIによる要約 (Gemini)")
+            st.markdown(cached_result["summary_text"])
+        elif can_summarize and gemini_model:
+            # 前回は要約に失敗していた場合だけ要約をやり直す
+            summary_text = render_summary(gemini_model, cached_result["full_raw_text"])
+            store_result(result_key, cached_result["transcript_text"], cached_result["full_raw_text"], summary_text)
+        elif not can_summarize:
+             st.warning("Gemini API の設定に問題があるため、要約機能は利用できません。")
+
+    elif run_clicked and not use_diarization:
+        decoder = None # PCM にデコード中の ffmpeg プロセス
+        try:
+            # --- ストリーミング認識: 話者分離なしで、認識できたところから順に表示する ---
+            st.subheader("🗣️ 文字起こし (逐次表示)")
+            decoder, decoder_feeder, decoder_error_log = start_ffmpeg(io.BytesIO(audio_data), output_format="s16le")
+            transcript_container = st.container()
+
+            # 長い音声は区間ごとの要約を文字起こしと並行して生成し、最後にそれらを統合して全体の要約にする
+            # (文字起こしの待ち時間に Gemini の処理を重ね、全文をもう一度 Gemini に送ることもしない)
+            segment_summaries = [] # 区間ごとの要約 (Future)
+            segment_summary_placeholder = st.empty() # 最初の区間が確定するまでは何も表示されない
+            rendered_done_count = [0] # 表示済みの完了した区間数
+
+            def on_segment(segment_text):
+                segment_summaries.append(
+                    get_background_executor().submit(summarize_segment, gemini_model, segment_text)
+                )
+                render_segment_summaries(segment_summary_placeholder, segment_summaries)
+
+            def refresh_segment_summaries():
+                # 完了した区間が増えたときだけ表示を更新する
+                done_count = sum(future.done() for future in segment_summaries)
+                if done_count != rendered_done_count[0]:
+                    rendered_done_count[0] = done_count
+                    render_segment_summaries(segment_summary_placeholder, segment_summaries)
+
+            summarize_enabled = can_summarize and gemini_model
+            with st.spinner('Google Cloud STT で文字起こしを実行中 (ストリーミング)...'):
+                full_raw_text, last_segment_text = transcribe_streaming(
+                    speech_client,
+                    decoder.stdout,
+                    transcript_container,
+                    on_segment=on_segment if summarize_enabled else None,
+                    on_response=refresh_segment_summaries if summarize_enabled else None,
+                )
+            wait_ffmpeg(decoder, decoder_feeder, decoder_error_log)
+
+            if not full_raw_text:
+                st.warning("音声から文字を認識できませんでした。")
+            else:
+                st.success("文字起こしが完了しました。")
+                # --- Gemini API による要約 ---
+                summary_text = None
+                if can_summarize and gemini_model:
+                    segment_results = None
+                    if segment_summaries:
+                        with st.spinner("区間ごとの要約の完了を待っています..."):
+                            for _ in as_completed(segment_summaries):
+                                render_segment_summaries(segment_summary_placeholder, segment_summaries)
+                        # 1 区間でも失敗していれば、全文から要約する
+                        if not any(future.exception() for future in segment_summaries):
+                            segment_results = [future.result() for future in segment_summaries]
+                    summary_text = render_summary(
+                        gemini_model,
+                        full_raw_text,
+                        segment_results=segment_results,
+                        last_segment_text=last_segment_text,
+                    )
+                elif not can_summarize:
+                     st.warning("Gemini API の設定に問題があるため、要約機能は利用できません。")
+                store_result(result_key, full_raw_text, full_raw_text, summary_text)
+
+        except Exception as e:
+            st.error(f"処理中に予期せぬエラーが発生しました: {e}")
+
+        finally:
+            # 途中でエラーになった場合に ffmpeg が残らないようにする
+            if decoder and decoder.poll() is None:
+                decoder.kill()
+
+    elif run_clicked:
         gcs_uri = None
-        blob_name = None
+        blob = None # アップロードした一時ファイル (削除時にそのまま使う)
         converted_file_data = None # 変換後のデータ用
         output_format = "flac" # 出力形式
+        content_type = None # GCS にアップロードする際の Content-Type
+        encoder = None # FLAC エンコード中の ffmpeg プロセス
+        encoder_feeder = None
+        encoder_error_log = None
+        inline_content = None # 短い音声を recognize に直接渡す場合のデータ
+        base_recognition_config, transcoded_recognition_config, _ = get_recognition_configs()
+        recognition_config = base_recognition_config # FLAC / WAV はヘッダから判別されるので共通設定のまま使う
+        response = None
 
         try:
-            # --- Step 1: 音声ファイルをFLACに変換 ---
-            st.info(f"アップロードされたファイル ({uploaded_file.name}) を {output_format.upper()} に変換中...")
+            # --- Step 1: 音声ファイルをFLACに変換 (STT がそのまま扱える形式は変換不要) ---
             try:
-                # ファイルポインタを先頭に戻す (重要)
-                uploaded_file.seek(0)
-                # ファイル名から拡張子を取得 (pydubに形式を伝えるため)
+                # ファイル名から拡張子を取得 (変換が必要かどうかの判定に使う)
                 file_extension = os.path.splitext(uploaded_file.name)[1].lower().replace('.', '')
                 if not file_extension: # 拡張子がない場合はタイプから推測を試みる
                     if '/' in uploaded_file.type:
@@ -92,115 +676,161 @@ if uploaded_file is not None and speech_client and storage_client:
                         # 不明な場合はエラーにするか、デフォルトを試す (ここではエラー)
                         raise ValueError("ファイルの拡張子またはMIMEタイプから形式を特定できません。")
 
-                # pydub で読み込み (ファイルオブジェクトと形式を指定)
-                audio = AudioSegment.from_file(uploaded_file, format=file_extension)
+                audio_info = probe_audio(audio_data)
+                # 複数チャンネルの音声は audio_channel_count を指定しないと STT で扱えないので、変換してモノラルにする
+                is_mono = audio_info["channels"] == 1
+                is_native_header_format = (
+                    is_mono
+                    and file_extension in SUPPORTED_NATIVE_FORMATS
+                    and audio_info["codec_name"] in SUPPORTED_NATIVE_CODECS
+                )
+                native_encoding = None
+                if is_mono and file_extension in NATIVE_CODEC_FORMATS and audio_info["sample_rate"]:
+                    native_encoding = NATIVE_CODEC_ENCODINGS.get(audio_info["codec_name"])
 
-                # FLAC形式でメモリ上のバッファにエクスポート
-                flac_buffer = io.BytesIO()
-                audio.export(flac_buffer, format=output_format)
-                flac_buffer.seek(0) # バッファのポインタを先頭に戻す
-                converted_file_data = flac_buffer # 変換後のデータを保持
-                st.success(f"{output_format.upper()} への変換完了。")
+                if is_native_header_format or native_encoding:
+                    # STT がそのまま扱える形式なので、デコード・再エンコードせず元のデータを使う
+                    output_format = file_extension
+                    content_type = uploaded_file.type or f'audio/{output_format}'
+                    if native_encoding:
+                        # Ogg Opus / AMR はエンコーディングとサンプルレートを共通設定に上書きして渡す
+                        recognition_config = speech.RecognitionConfig(
+                            base_recognition_config,
+                            encoding=native_encoding,
+                            sample_rate_hertz=audio_info["sample_rate"],
+                        )
+                    st.info(f"{output_format.upper()} 形式のため変換をスキップします。")
+                    if is_short_audio(audio_info["duration"]):
+                        inline_content = audio_data
+                    else:
+                        converted_file_data = io.BytesIO(audio_data)
+                elif FFMPEG_PATH:
+                    content_type = f'audio/{output_format}'
+                    recognition_config = transcoded_recognition_config
+                    if is_short_audio(audio_info["duration"]):
+                        # 短い音声はまとめて変換し、GCS を経由せずに文字起こしする
+                        st.info(f"アップロードされたファイル ({uploaded_file.name}) を {output_format.upper()} に変換中...")
+                        inline_content = encode_flac(audio_data)
+                        st.success(f"{output_format.upper()} への変換完了。")
+                    else:
+                        st.info(f"アップロードされたファイル ({uploaded_file.name}) を {output_format.upper()} に変換しながらアップロードします...")
+                        # ffmpeg で FLAC にエンコードし、出力をそのまま GCS へ流す (FLAC 全体をメモリに保持しない)
+                        encoder, encoder_feeder, encoder_error_log = start_ffmpeg(io.BytesIO(audio_data))
+                        converted_file_data = PipeReader(encoder.stdout) # 変換後のデータ (ストリーム)
+                else:
+                    content_type = f'audio/{output_format}'
+                    recognition_config = transcoded_recognition_config
+                    st.info(f"アップロードされたファイル ({uploaded_file.name}) を {output_format.upper()} に変換中...")
+                    # ffmpeg が見つからない場合は pydub で読み込み (ファイルオブジェクトと形式を指定)
+                    audio = AudioSegment.from_file(io.BytesIO(audio_data), format=file_extension)
+                    # ffmpeg で変換する場合と同じく 16 kHz・モノラル・16 bit に揃えてデータ量を減らす
+                    audio = audio.set_channels(FLAC_CHANNELS).set_frame_rate(FLAC_SAMPLE_RATE_HERTZ).set_sample_width(2)
+
+                    # FLAC形式でメモリ上のバッファにエクスポート
+                    flac_buffer = io.BytesIO()
+                    audio.export(flac_buffer, format=output_format)
+                    flac_buffer.seek(0) # バッファのポインタを先頭に戻す
+                    if is_short_audio(len(audio) / 1000):
+                        inline_content = flac_buffer.getvalue()
+                    else:
+                        converted_file_data = flac_buffer # 変換後のデータを保持
+                    st.success(f"{output_format.upper()} への変換完了。")
+
+                if inline_content is not None and len(inline_content) >= INLINE_MAX_BYTES:
+                    # 短くてもデータが大きすぎる場合は GCS 経由にする
+                    converted_file_data = io.BytesIO(inline_content)
+                    inline_content = None
 
             except Exception as convert_e:
                 st.error(f"音声ファイルの形式変換中にエラーが発生しました: {convert_e}")
                 st.error(f"対応していない形式か、環境にffmpegがインストールされていない可能性があります。")
                 st.stop() # 変換に失敗したらここで停止
 
-            # --- Step 2: 変換後のファイルを GCS にアップロード ---
-            if converted_file_data:
-                with st.spinner(f'変換された {output_format.upper()} ファイルを GCS にアップロード中...'):
-                    bucket = storage_client.bucket(GCS_BUCKET_NAME)
-                    # 元のファイル名から拡張子を除き、新しい拡張子とタイムスタンプを付与
-                    base_name = os.path.splitext(uploaded_file.name)[0]
-                    blob_name = f"audio_uploads/{int(time.time())}_{base_name}.{output_format}"
-                    blob = bucket.blob(blob_name)
-
-                    # メモリバッファから GCS へアップロード
-                    blob.upload_from_file(converted_file_data, content_type=f'audio/{output_format}')
+            # --- Step 2: 変換後のファイルを GCS にアップロード (短い音声はスキップ) ---
+            if converted_file_data is not None:
+                with st.spinner(f'{output_format.upper()} ファイルを GCS にアップロード中...'):
+                    # 実行ごとに一意な名前にする (同じ音声を別のセッションで同時に処理しても、
+                    # 他方の削除で文字起こし中のオブジェクトが消えないように)
+                    blob_name = f"audio_uploads/{audio_digest}_{uuid.uuid4().hex}.{output_format}"
+                    blob = gcs_bucket.blob(blob_name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+
+                    # resumable upload でチャンクごとに GCS へアップロード (失敗したチャンクは再送)
+                    # エンコーダの出力はパイプなので巻き戻さない
+                    blob.upload_from_file(
+                        converted_file_data,
+                        content_type=content_type,
+                        rewind=encoder is None,
+                        retry=DEFAULT_RETRY,
+                    )
+                    if encoder:
+                        wait_ffmpeg(encoder, encoder_feeder, encoder_error_log)
+                        st.success(f"{output_format.upper()} への変換完了。")
                     gcs_uri = f"gs://{GCS_BUCKET_NAME}/{blob_name}"
                     st.info(f"GCS にアップロード完了: {gcs_uri}")
 
-            # --- Step 3: Google Cloud STT (long_running_recognize) ---
-            if gcs_uri:
-                with st.spinner(f'Google Cloud STT で文字起こしを実行中 (非同期処理)...'):
-                    audio_gcs = speech.RecognitionAudio(uri=gcs_uri) # GCS URI を指定
-
-                    # 話者分離を有効にした RecognitionConfig (FLACなのでエンコ―ディング指定不要)
-                    diarization_config = speech.SpeakerDiarizationConfig(
-                        enable_speaker_diarization=True,
-                        min_speaker_count=2,
-                        max_speaker_count=6,
-                    )
-                    config = speech.RecognitionConfig(
-                        language_code="ja-JP",
-                        enable_automatic_punctuation=True,
-                        diarization_config=diarization_config, # 話者分離を再度有効化
-                    )
+            # --- Step 3: Google Cloud STT (短い音声は recognize、それ以外は long_running_recognize) ---
+            if inline_content is not None or gcs_uri:
+                with st.spinner(f'Google Cloud STT で文字起こしを実行中...'):
+                    if inline_content is not None:
+                        # 短い音声は GCS を経由せず、データを直接渡して同期認識する
+                        audio_inline = speech.RecognitionAudio(content=inline_content)
+                        response = speech_client.recognize(config=recognition_config, audio=audio_inline)
+                    else:
+                        audio_gcs = speech.RecognitionAudio(uri=gcs_uri) # GCS URI を指定
 
-                    # 非同期認識を開始
-                    operation = speech_client.long_running_recognize(config=config, audio=audio_gcs)
-                    st.info("非同期文字起こし処理を開始しました。完了まで時間がかかります...")
+                        # 非同期認識を開始
+                        operation = speech_client.long_running_recognize(config=recognition_config, audio=audio_gcs)
+                        st.info("非同期文字起こし処理を開始しました。完了まで時間がかかります...")
 
-                    # オペレーションの完了を待つ (タイムアウトは長めに設定)
-                    # 30分程度の音声なら1800秒(30分)くらい見ておく
-                    response = operation.result(timeout=1800)
+                        # オペレーションの完了を、進捗を表示しながら待つ
+                        response = wait_for_operation(operation, st.progress(0, text="文字起こしの進捗: 0%"))
                     st.success("文字起こしが完了しました。")
 
-                    if not response.results:
-                        st.warning("音声から文字を認識できませんでした。")
+            if response is not None:
+                if not response.results:
+                    st.warning("音声から文字を認識できませんでした。")
+                else:
+                    # --- Step 4: 話者分離に基づいたスクリプト整形 ---
+                    st.subheader("🗣️ 話者分離 整形済みスクリプト")
+                    # 同じ話者が続く単語をまとめ、話者ごとに 1 ブロックとして結合する
+                    words = [
+                        word_info
+                        for result in response.results
+                        if result.alternatives
+                        for word_info in result.alternatives[0].words
+                    ]
+                    if words:
+                        transcript_text = "\n\n".join(
+                            f"**話者 {speaker_tag}:**\n" + " ".join(word_info.word for word_info in group)
+                            for speaker_tag, group in groupby(words, key=attrgetter("speaker_tag"))
+                        )
+                        full_raw_text = " ".join(word_info.word for word_info in words)
                     else:
-                        # --- Step 4: 話者分離に基づいたスクリプト整形 ---
-                        st.subheader("🗣️ 話者分離 整形済みスクリプト")
-                        transcript_text = ""
-                        current_speaker = -1
-                        full_raw_text = ""
-                        for result in response.results:
-                            if result.alternatives and result.alternatives[0].words:
-                                for word_info in result.alternatives[0].words:
-                                    if word_info.speaker_tag != current_speaker:
-                                        if current_speaker != -1:
-                                            transcript_text += "\n\n"
-                                        transcript_text += f"**話者 {word_info.speaker_tag}:**\n"
-                                        current_speaker = word_info.speaker_tag
-                                    transcript_text += word_info.word + " "
-                                    full_raw_text += word_info.word + " "
-                            elif result.alternatives:
-                                transcript_text += result.alternatives[0].transcript + "\n"
-                                full_raw_text += result.alternatives[0].transcript + "\n"
-                        st.markdown(transcript_text.strip())
-
-                        # --- Step 5: Gemini API による要約 ---
-                        if can_summarize and full_raw_text and gemini_model:
-                            st.subheader("📝 AIによる要約 (Gemini)")
-                            with st.spinner("Gemini API で要約を生成中..."):
-                                prompt = f"""
-                                以下の会議書き起こしテキストを分析し、主要な議題とそれぞれの内容の要点を箇条書きで簡潔にまとめてください。
-                                まずはGoogle StTによる書き起こしテキストを日本語に編集しログ形式で出力した後、その内容の要点をまとめてください。
-                                --- 書き起こしテキスト ---
-                                {full_raw_text.strip()}
-                                --- 要約 ---
-                                """
-                                try:
-                                    gemini_response = gemini_model.generate_content(prompt)
-                                    st.markdown(gemini_response.text)
-                                    st.success("要約が完了しました。")
-                                except Exception as e:
-                                    st.error(f"Gemini API での要約生成中にエラーが発生しました: {e}")
-                        elif not can_summarize:
-                             st.warning("Gemini API の設定に問題があるため、要約機能は利用できません。")
+                        # 単語ごとの情報がない場合は認識結果の文章をそのまま使う
+                        full_raw_text = "\n".join(
+                            result.alternatives[0].transcript for result in response.results if result.alternatives
+                        )
+                        transcript_text = full_raw_text
+                    st.markdown(transcript_text.strip())
+
+                    # --- Step 5: Gemini API による要約 ---
+                    summary_text = None
+                    if can_summarize and full_raw_text and gemini_model:
+                        summary_text = render_summary(gemini_model, full_raw_text)
+                    elif not can_summarize:
+                         st.warning("Gemini API の設定に問題があるため、要約機能は利用できません。")
+                    store_result(result_key, transcript_text.strip(), full_raw_text, summary_text)
 
         except Exception as e:
             st.error(f"処理中に予期せぬエラーが発生しました: {e}")
 
         finally:
+            # 途中でエラーになった場合に ffmpeg が残らないようにする
+            if encoder and encoder.poll() is None:
+                encoder.kill()
+
             # --- Step 6: GCS から一時ファイルを削除 ---
-            if blob_name and storage_client:
-                try:
-                    st.info(f"GCS から一時ファイル {blob_name} の削除を試みます...")
-                    bucket = storage_client.bucket(GCS_BUCKET_NAME)
-                    blob = bucket.blob(blob_name)
-                    blob.delete()
-                    st.info(f"GCS から一時ファイル {blob_name} を削除しました。")
-                except Exception as e:
-                    st.warning(f"GCS からの一時ファイル削除中にエラー: {e}") # 削除失敗は警告にとどめる
\ No newline at end of file
+            # 削除の完了はユーザーが待つ必要がないので、バックグラウンドで実行して結果を待たない
+            if blob is not None:
+                get_background_executor().submit(delete_gcs_blob, blob)
+                st.info(f"GCS から一時ファイル {blob.name} の削除をバックグラウンドで開始しました。")
\ No newline at end of file